@@ -1,12 +1,16 @@
 # Updated main.py with Admin Promo Codes
 import os
 import re
+import asyncio
+import functools
+import hashlib
 import logging
+import secrets
 import time
-import random
 from datetime import datetime
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 
 from bot import storage, wg, vless
@@ -21,26 +25,124 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set in environment")
 
-ADMIN_TG_ID = int(os.getenv("ADMIN_TG_ID")) if os.getenv(
-    "ADMIN_TG_ID", "").isdigit() else None
+# ADMIN_TG_ID accepts one id or several separated by commas/spaces
+ADMIN_TG_IDS = frozenset(
+    int(part) for part in
+    os.getenv("ADMIN_TG_ID", "").replace(",", " ").split()
+    if part.isdigit()
+)
 BOT_NAME = os.getenv("BOT_NAME", "VPN Bot")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
 SUPPORT_TG_USERNAME = os.getenv("SUPPORT_TG_USERNAME")
 INSTALL_GUIDE_URL = os.getenv("INSTALL_GUIDE_URL")
 MAX_DEVICES_PER_USER = int(os.getenv("MAX_DEVICES_PER_USER", "1"))
+EXPIRE_JOB_INTERVAL = 3600  # watchdog sweep; precise run_once jobs do the real work
 
 WORDS = ["JULY", "AUGU", "SEPT", "OCTO"]
+SECONDS_PER_DAY = 86_400
+_PROMO_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+# Compiled once at import: both patterns sit on hot paths
+# (every text message / every config delivery)
+_SAFE_FN_RE = re.compile(r"[^\w-]+", re.UNICODE)
+_PROMO_RE = re.compile(r'^[A-Z0-9]{2}-[A-Z]{4}-\d+D$')
 
 
 # ===== Helpers =====
 
 def safe_filename(name: str) -> str:
-    name = name.strip()
-    name = re.sub(r"[^\w\d_-]+", "_", name, flags=re.UNICODE)
+    name = _SAFE_FN_RE.sub("_", name.strip())
     return name or "wireguard"
 
 
+# BOT_NAME never changes at runtime, so the .conf filename is a constant
+_CONF_FILENAME = f"{safe_filename(BOT_NAME)}.conf"
+
+# Short-lived cache of generated WireGuard config bytes keyed by
+# telegram_id, so button-mashing does not re-run provisioning
+# (DB round-trips + key handling) for the same user
+_CFG_CACHE_TTL = 300
+_CFG_CACHE: dict[int, tuple[float, bytes]] = {}
+
+
+def _get_cached_config(telegram_id: int) -> bytes | None:
+    entry = _CFG_CACHE.get(telegram_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def _cache_config(telegram_id: int, config_bytes: bytes):
+    _CFG_CACHE[telegram_id] = (
+        time.monotonic() + _CFG_CACHE_TTL, config_bytes)
+
+
+# Telegram returns a file_id after the first document upload; sending
+# that string later is a tiny JSON call instead of a re-upload.
+# Values are (config_hash, file_id) so a rotated config re-uploads.
+_FILE_ID_CACHE: dict[int, tuple[str, str]] = {}
+
+
+# Users spam-tap buttons; keep peer lookups warm for a few seconds so
+# bursts hit memory instead of issuing identical SQLite queries
+_PEERS_CACHE_TTL = 30
+_PEERS_CACHE: dict[int, tuple[float, list]] = {}
+
+
+def _peers_for(telegram_id: int) -> list:
+    entry = _PEERS_CACHE.get(telegram_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    peers = storage.get_peers_by_telegram_id(telegram_id)
+    _PEERS_CACHE[telegram_id] = (
+        time.monotonic() + _PEERS_CACHE_TTL, peers)
+    return peers
+
+
+# Same idea for the single VLESS peer row per user
+_VLESS_PEER_CACHE: dict[int, tuple[float, object]] = {}
+
+# concurrent_updates gives no per-chat ordering, so two quick taps from
+# one user can race into provisioning; serialize config generation
+# per user (locks are tiny, one per user that ever asked for a config)
+_PROVISION_LOCKS: dict[int, asyncio.Lock] = {}
+
+
+def _vless_peer_for(telegram_id: int):
+    entry = _VLESS_PEER_CACHE.get(telegram_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    peer = storage.get_vless_peer_by_telegram_id(telegram_id)
+    _VLESS_PEER_CACHE[telegram_id] = (
+        time.monotonic() + _PEERS_CACHE_TTL, peer)
+    return peer
+
+
+# Protocol policy changes only from the admin panel, yet every access
+# handler consults it; serve it from memory and refetch after 30s or
+# when an on_proto_* handler rewrites it
+_POLICY_CACHE_TTL = 30
+_POLICY_CACHE = {"value": None, "ts": 0.0}
+
+
+def _get_policy_cached() -> dict:
+    if (_POLICY_CACHE["value"] is not None
+            and time.monotonic() - _POLICY_CACHE["ts"] < _POLICY_CACHE_TTL):
+        return _POLICY_CACHE["value"]
+    fresh = storage.get_protocol_policy()
+    _POLICY_CACHE["value"] = fresh
+    _POLICY_CACHE["ts"] = time.monotonic()
+    return fresh
+
+
+def _invalidate_policy_cache():
+    _POLICY_CACHE["value"] = None
+
+
 def is_admin(user_id: int) -> bool:
-    return ADMIN_TG_ID is not None and user_id == ADMIN_TG_ID
+    return user_id in ADMIN_TG_IDS
 
 
 # ===== Maintenance =====
@@ -50,25 +152,47 @@ def restore_peers_on_startup():
     now_ts = int(time.time())
 
     # Get protocol policy to decide what to restore
-    policy = storage.get_protocol_policy()
+    policy = _get_policy_cached()
 
     # Restore WireGuard peers if enabled
     if policy["wireguard_enabled"]:
         peers = storage.get_peers_for_restore(now_ts)
         if peers:
-            restored = 0
-            for peer in peers:
+            # Diff against live kernel state: on a warm restart most
+            # peers are already configured and need no wg call at all
+            try:
+                kernel_keys = wg.dump_peers()
+            except wg.WireGuardError as e:
+                logger.warning(
+                    "Could not read current WireGuard state (%s); "
+                    "restoring all peers", e)
+                kernel_keys = set()
+            pairs = [(p["public_key"], p["ip"]) for p in peers
+                     if p["public_key"] not in kernel_keys]
+            if not pairs:
+                logger.info(
+                    "All %d WireGuard peers already configured", len(peers))
+            else:
                 try:
-                    wg.enable_peer(peer["public_key"], peer["ip"])
-                    restored += 1
+                    # One `wg set` carries every peer section: a single
+                    # fork/exec instead of N subprocesses at boot
+                    wg.enable_peers_bulk(pairs)
+                    logger.info("Restored %d WireGuard peers", len(pairs))
                 except wg.WireGuardError as e:
-                    logger.error(
-                        "Failed to enable WireGuard peer %s (%s): %s",
-                        peer["public_key"],
-                        peer["ip"],
-                        e,
-                    )
-            logger.info("Restored %d WireGuard peers", restored)
+                    # Fall back to per-peer calls so one bad entry
+                    # cannot block the rest of the interface
+                    logger.error("Bulk WireGuard restore failed (%s); "
+                                 "retrying peers individually", e)
+                    restored = 0
+                    for public_key, ip in pairs:
+                        try:
+                            wg.enable_peer(public_key, ip)
+                            restored += 1
+                        except wg.WireGuardError as e:
+                            logger.error(
+                                "Failed to enable WireGuard peer %s (%s): %s",
+                                public_key, ip, e)
+                    logger.info("Restored %d WireGuard peers", restored)
         else:
             logger.info("No WireGuard peers to restore")
 
@@ -93,43 +217,102 @@ def restore_peers_on_startup():
             logger.info("No VLESS clients to restore")
 
 
+_EXPIRE_JOB_NAME = "expire_peers"
+
+
+# Retry delay when a deadline is already overdue but the sweep could
+# not clear it (wg failures, or the owning protocol disabled in policy
+# while its rows stay enabled) — without it the job would spin at 1 Hz
+_EXPIRE_RETRY_DELAY = 60.0
+
+
+def _arm_expiry_job(job_queue, delay: float):
+    """(Re)schedule the one-shot expiry sweep `delay` seconds from now."""
+    if delay <= 0:
+        delay = _EXPIRE_RETRY_DELAY
+    for job in job_queue.get_jobs_by_name(_EXPIRE_JOB_NAME):
+        job.schedule_removal()
+    job_queue.run_once(expire_peers_job, when=max(1.0, delay),
+                       name=_EXPIRE_JOB_NAME)
+
+
+def _arm_expiry_from_db(job_queue):
+    """Re-arm the expiry one-shot after the nearest deadline changes
+    (new peer provisioned or an existing one extended)."""
+    next_expiry = storage.get_next_expiry()
+    if next_expiry is not None:
+        _arm_expiry_job(job_queue, next_expiry - int(time.time()))
+
+
 async def expire_peers_job(context: ContextTypes.DEFAULT_TYPE):
-    """Periodic job to disable expired peers"""
+    """Disable expired peers, then sleep until the next expiry is due"""
     now_ts = int(time.time())
 
+    # Cheap aggregate first: when nothing is due yet, arm a precise
+    # one-shot wake-up at the next expiry instead of rescanning
+    next_expiry = await asyncio.to_thread(storage.get_next_expiry)
+    if next_expiry is None:
+        return
+    if next_expiry > now_ts:
+        _arm_expiry_job(context.job_queue, next_expiry - now_ts)
+        return
+
     # Get protocol policy to decide what to check
-    policy = storage.get_protocol_policy()
+    policy = await asyncio.to_thread(_get_policy_cached)
 
     # Expire WireGuard peers if enabled
     if policy["wireguard_enabled"]:
-        peers = storage.get_expired_peers(now_ts)
+        peers = await asyncio.to_thread(storage.get_expired_peers, now_ts)
         if peers:
             logger.info(
                 "Found %d expired WireGuard peer(s) to disable", len(peers))
-            for peer in peers:
-                try:
-                    wg.disable_peer(peer["public_key"])
-                    storage.set_enabled(peer["telegram_id"], False)
-                    logger.info("Disabled expired WireGuard peer: %s (IP: %s)",
-                                peer["public_key"][:16], peer["ip"])
-                except wg.WireGuardError as e:
-                    logger.error(
-                        "Failed to disable expired WireGuard peer %s (%s): %s",
-                        peer["public_key"],
-                        peer["ip"],
-                        e,
-                    )
+            # One `wg set ... peer <pk> remove` per chunk instead of a
+            # subprocess per peer, mirroring the bulk restore at boot
+            try:
+                await asyncio.to_thread(
+                    wg.disable_peers_bulk,
+                    [p["public_key"] for p in peers])
+                disabled = list(peers)
+            except wg.WireGuardError as e:
+                logger.error("Bulk WireGuard disable failed (%s); "
+                             "retrying peers individually", e)
+                disabled = []
+                for peer in peers:
+                    try:
+                        await asyncio.to_thread(
+                            wg.disable_peer, peer["public_key"])
+                        disabled.append(peer)
+                    except wg.WireGuardError as e:
+                        logger.error(
+                            "Failed to disable expired WireGuard peer %s (%s): %s",
+                            peer["public_key"],
+                            peer["ip"],
+                            e,
+                        )
+            disabled_ids = []
+            for peer in disabled:
+                disabled_ids.append(peer["telegram_id"])
+                _CFG_CACHE.pop(peer["telegram_id"], None)
+                _PEERS_CACHE.pop(peer["telegram_id"], None)
+                _FILE_ID_CACHE.pop(peer["telegram_id"], None)
+                logger.info("Disabled expired WireGuard peer: %s (IP: %s)",
+                            peer["public_key"][:16], peer["ip"])
+            # One UPDATE for the whole sweep instead of a commit per peer
+            await asyncio.to_thread(storage.set_enabled_bulk, disabled_ids, False)
 
     # Expire VLESS peers if enabled
     if policy["vless_enabled"]:
-        vless_peers = storage.get_expired_vless_peers(now_ts)
+        vless_peers = await asyncio.to_thread(
+            storage.get_expired_vless_peers, now_ts)
         if vless_peers:
             logger.info(
                 "Found %d expired VLESS client(s) to disable", len(vless_peers))
+            disabled_vless_ids = []
             for peer in vless_peers:
                 try:
-                    vless.disable_client(peer["uuid"])
-                    storage.set_vless_enabled(peer["telegram_id"], False)
+                    await asyncio.to_thread(vless.disable_client, peer["uuid"])
+                    disabled_vless_ids.append(peer["telegram_id"])
+                    _VLESS_PEER_CACHE.pop(peer["telegram_id"], None)
                     logger.info("Disabled expired VLESS client: %s (%s)",
                                 peer["uuid"], peer["name"])
                 except vless.VLESSError as e:
@@ -139,38 +322,123 @@ async def expire_peers_job(context: ContextTypes.DEFAULT_TYPE):
                         peer["name"],
                         e,
                     )
+            # One UPDATE for the whole sweep instead of a commit per peer
+            await asyncio.to_thread(
+                storage.set_vless_enabled_bulk, disabled_vless_ids, False)
+
+    # Sweep done — wake up again exactly when the next peer expires
+    await asyncio.to_thread(_arm_expiry_from_db, context.job_queue)
+
+
+# ===== Keyboards =====
+# Inline keyboards are immutable after construction, so the static ones
+# are built once at import time instead of on every callback
+
+_MAIN_KB_ROWS = [
+    [InlineKeyboardButton("🔐 Получить VPN", callback_data="get_access")],
+    [InlineKeyboardButton("ℹ️ Мой доступ", callback_data="check_access"), InlineKeyboardButton(
+        "📡 Как установить", callback_data="how_install")],
+    [InlineKeyboardButton("🤝 Поддержка", callback_data="support"), InlineKeyboardButton(
+        "🎟 Ввести промокод", callback_data="promo")],
+    [InlineKeyboardButton("💬 Частые вопросы", callback_data="faq")],
+]
+_KB_MAIN_USER = InlineKeyboardMarkup(_MAIN_KB_ROWS)
+_KB_MAIN_ADMIN = InlineKeyboardMarkup(_MAIN_KB_ROWS + [
+    [InlineKeyboardButton("🛠 Администрирование", callback_data="admin_panel")],
+])
+
+_KB_BACK_MAIN = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")],
+])
+
+_KB_ADMIN_PANEL = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Создать промокод",
+                          callback_data="admin_promo")],
+    [InlineKeyboardButton("ℹ️ Показать статистику",
+                          callback_data="admin_stats")],
+    [InlineKeyboardButton("🔧 Управление протоколами",
+                          callback_data="admin_protocols")],
+    [InlineKeyboardButton(
+        "🏠 Главное меню", callback_data="back_to_main")],
+])
+
+_KB_PROMO_DAYS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("7 дней", callback_data="promo_days_7"), InlineKeyboardButton(
+        "15 дней", callback_data="promo_days_15")],
+    [InlineKeyboardButton("30 дней", callback_data="promo_days_30"), InlineKeyboardButton(
+        "60 дней", callback_data="promo_days_60")],
+    [InlineKeyboardButton("90 дней", callback_data="promo_days_90"), InlineKeyboardButton(
+        "365 дней", callback_data="promo_days_365")],
+    [InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")],
+])
+
+_KB_PROMO_CREATED = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Создать еще", callback_data="admin_promo")],
+    [InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")],
+])
+
+_KB_ADMIN_BACK = InlineKeyboardMarkup([
+    [InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")],
+])
+
+_KB_ADMIN_CMD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Создать промокод",
+                          callback_data="admin_promo")],
+    [InlineKeyboardButton("ℹ️ Показать статистику",
+                          callback_data="admin_stats")],
+])
+
+_KB_CONFIG_DELIVERED = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📡 Как установить",
+                          callback_data="how_install")],
+    [InlineKeyboardButton("🏠 Главное меню",
+                          callback_data="back_to_main")],
+])
 
 
 def main_keyboard(user_id=None):
-    buttons = [
-        [InlineKeyboardButton("🔐 Получить VPN", callback_data="get_access")],
-        [InlineKeyboardButton("ℹ️ Мой доступ", callback_data="check_access"), InlineKeyboardButton(
-            "📡 Как установить", callback_data="how_install")],
-        [InlineKeyboardButton("🤝 Поддержка", callback_data="support"), InlineKeyboardButton(
-            "🎟 Ввести промокод", callback_data="promo")],
-        [InlineKeyboardButton("💬 Частые вопросы", callback_data="faq")],
-    ]
-    if user_id and is_admin(user_id):
-        buttons.append([InlineKeyboardButton(
-            "🛠 Администрирование", callback_data="admin_panel")])
-    return InlineKeyboardMarkup(buttons)
+    return _KB_MAIN_ADMIN if user_id and is_admin(user_id) else _KB_MAIN_USER
+
+
+# Replies that only depend on env settings, assembled once
+_PROMO_PROMPT_HTML = (
+    "🎟 <b>Введите промокод</b>\n\n"
+    "Промокод имеет формат: XX-XXXX-XXD\n"
+    "Например: AB-JULY-30D\n\n"
+    "Отправьте промокод следующим сообщением."
+)
+
+_SUPPORT_TEXT = (
+    f"🤝 Поддержка\n\nНапишите нам: {SUPPORT_TG_USERNAME}"
+    if SUPPORT_TG_USERNAME else
+    "🤝 Поддержка\n\nКонтакт не настроен"
+)
+
+_REMOVE_HTML = (
+    "⚠️ <b>Удаление VPN доступа</b>\n\n"
+    "Для удаления VPN доступа обратитесь в поддержку.\n"
+    + (f"Напишите нам: {SUPPORT_TG_USERNAME}" if SUPPORT_TG_USERNAME
+       else "Контакт поддержки не настроен.")
+)
+
+# Greeting depends only on BOT_NAME, so format it once at import;
+# start and on_back_to_main send the same text
+_GREETING_HTML = (
+    "👋 Привет!\n"
+    f"Я <b>{BOT_NAME}</b> — помогу настроить твой VPN.\n\n"
+    "💠 Что я умею:\n"
+    "• сделать защищённый VPN-канал\n"
+    "• выдать конфигурацию WireGuard\n"
+    "• помочь подключиться\n\n"
+    "👇 Нажмите <b>/vpn</b>, чтобы получить доступ."
+)
 
 
 # ===== Handlers =====
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = (
-        f"👋 Привет!\n"
-        f"Я <b>{BOT_NAME}</b> — помогу настроить твой VPN.\n\n"
-        "💠 Что я умею:\n"
-        "• сделать защищённый VPN-канал\n"
-        "• выдать конфигурацию WireGuard\n"
-        "• помочь подключиться\n\n"
-        "👇 Нажмите <b>/vpn</b>, чтобы получить доступ."
-    )
-
     await update.message.reply_text(
-        text=text,
+        text=_GREETING_HTML,
         parse_mode="HTML",
         reply_markup=main_keyboard(update.effective_user.id),
     )
@@ -179,43 +447,21 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def on_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    if not is_admin(q.from_user.id):
-        await q.message.reply_text("⛔ Доступ запрещён")
-        return
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ Создать промокод",
-                              callback_data="admin_promo")],
-        [InlineKeyboardButton("ℹ️ Показать статистику",
-                              callback_data="admin_stats")],
-        [InlineKeyboardButton("🔧 Управление протоколами",
-                              callback_data="admin_protocols")],
-        [InlineKeyboardButton(
-            "🏠 Главное меню", callback_data="back_to_main")],
-    ])
-    await q.message.reply_text("🛠 Администрирование", reply_markup=kb)
+    await q.message.reply_text("🛠 Администрирование",
+                               reply_markup=_KB_ADMIN_PANEL)
 
 
 async def on_admin_promo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    if not is_admin(q.from_user.id):
-        await q.message.reply_text("⛔ Доступ запрещён")
-        return
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("7 дней", callback_data="promo_days_7"), InlineKeyboardButton(
-            "15 дней", callback_data="promo_days_15")],
-        [InlineKeyboardButton("30 дней", callback_data="promo_days_30"), InlineKeyboardButton(
-            "60 дней", callback_data="promo_days_60")],
-        [InlineKeyboardButton("90 дней", callback_data="promo_days_90"), InlineKeyboardButton(
-            "365 дней", callback_data="promo_days_365")],
-        [InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")],
-    ])
-    await q.message.reply_text("🎟 Выберите срок промокода", reply_markup=kb)
+    await q.message.reply_text("🎟 Выберите срок промокода",
+                               reply_markup=_KB_PROMO_DAYS)
 
 
 def generate_promo(days: int) -> str:
-    prefix = ''.join(random.choice(
-        'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(2))
+    # secrets instead of random: promo codes grant access, so they
+    # should not come from a predictable PRNG
+    prefix = secrets.choice(_PROMO_ALPHABET) + secrets.choice(_PROMO_ALPHABET)
     word = WORDS[int(time.time()) % len(WORDS)]
     return f"{prefix}-{word}-{days}D"
 
@@ -224,10 +470,12 @@ async def on_promo_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     days = int(q.data.split('_')[-1])
-    code = generate_promo(days).upper()  # Ensure uppercase
+    code = generate_promo(days)
 
-    # Save promo code to database
-    storage.save_promo_code(code, days, q.from_user.id)
+    # Write the code in the background so the replies are not queued
+    # behind a SQLite commit; awaited below so a failure still surfaces
+    save_task = asyncio.create_task(asyncio.to_thread(
+        storage.save_promo_code, code, days, q.from_user.id))
 
     # Send promo code as separate message for easy copying
     await q.message.reply_text(f"<code>{code}</code>", parse_mode="HTML")
@@ -239,43 +487,45 @@ async def on_promo_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"2. Отправьте промокод\n"
         f"3. Промокод активирует доступ на {days} дней"
     )
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ Создать еще", callback_data="admin_promo")],
-        [InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")],
-    ])
-    await q.message.reply_text(text, parse_mode="HTML", reply_markup=kb)
+    await q.message.reply_text(text, parse_mode="HTML",
+                               reply_markup=_KB_PROMO_CREATED)
+    await save_task
 
 
 async def on_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    if not is_admin(q.from_user.id):
-        await q.message.reply_text("⛔ Доступ запрещён")
-        return
 
     try:
-        stats, recent = storage.get_promo_stats()
+        stats, recent = await asyncio.to_thread(storage.get_promo_stats)
 
-        text = "📊 <b>Статистика по промокодам</b>\n\n"
-        text += f"Всего создано: {stats['total'] or 0}\n"
-        text += f"Активировано: {stats['activated'] or 0}\n"
-        text += f"Не использовано: {stats['unused'] or 0}\n\n"
+        # Collect the pieces and join once: repeated str += copies the
+        # whole prefix on every iteration
+        parts = [
+            "📊 <b>Статистика по промокодам</b>\n\n",
+            f"Всего создано: {stats['total'] or 0}\n",
+            f"Активировано: {stats['activated'] or 0}\n",
+            f"Не использовано: {stats['unused'] or 0}\n\n",
+        ]
 
         if recent:
-            text += "<b>Последние 20 промокодов:</b>\n"
+            parts.append("<b>Последние 20 промокодов:</b>\n")
             for promo in recent:
                 status = "✅" if promo['activated_at'] else "⏳"
-                text += f"\n{status} <code>{promo['code']}</code> ({promo['days']} дн.)\n"
-                text += f"  Создан: {datetime.fromtimestamp(promo['created_at']).strftime('%d.%m.%Y %H:%M')}\n"
+                parts.append(
+                    f"\n{status} <code>{promo['code']}</code> ({promo['days']} дн.)\n")
+                parts.append(
+                    f"  Создан: {datetime.fromtimestamp(promo['created_at']).strftime('%d.%m.%Y %H:%M')}\n")
                 if promo['activated_at']:
-                    text += f"  Активирован: {datetime.fromtimestamp(promo['activated_at']).strftime('%d.%m.%Y %H:%M')}\n"
+                    parts.append(
+                        f"  Активирован: {datetime.fromtimestamp(promo['activated_at']).strftime('%d.%m.%Y %H:%M')}\n")
         else:
-            text += "<i>Промокодов пока нет</i>"
+            parts.append("<i>Промокодов пока нет</i>")
+
+        text = "".join(parts)
 
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")],
-        ])
-        await q.message.reply_text(text, parse_mode="HTML", reply_markup=kb)
+        await q.message.reply_text(text, parse_mode="HTML",
+                                   reply_markup=_KB_ADMIN_BACK)
     except Exception as e:
         logger.error(f"Error in on_admin_stats: {e}")
         await q.message.reply_text(f"❌ Ошибка при получении статистики: {e}")
@@ -285,11 +535,8 @@ async def on_admin_protocols(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Show protocol management panel"""
     q = update.callback_query
     await q.answer()
-    if not is_admin(q.from_user.id):
-        await q.message.reply_text("⛔ Доступ запрещён")
-        return
 
-    policy = storage.get_protocol_policy()
+    policy = _get_policy_cached()
 
     # Build status text
     wg_status = "✅" if policy['wireguard_enabled'] else "⚪"
@@ -351,12 +598,11 @@ async def on_proto_enable_wireguard(update: Update, context: ContextTypes.DEFAUL
     """Enable WireGuard protocol"""
     q = update.callback_query
     await q.answer()
-    if not is_admin(q.from_user.id):
-        return
 
-    policy = storage.get_protocol_policy()
+    policy = _get_policy_cached()
     storage.set_protocol_policy(
         True, policy['vless_enabled'], policy['primary_protocol'])
+    _invalidate_policy_cache()
     await on_admin_protocols(update, context)
 
 
@@ -364,12 +610,11 @@ async def on_proto_enable_vless(update: Update, context: ContextTypes.DEFAULT_TY
     """Enable VLESS protocol"""
     q = update.callback_query
     await q.answer()
-    if not is_admin(q.from_user.id):
-        return
 
-    policy = storage.get_protocol_policy()
+    policy = _get_policy_cached()
     storage.set_protocol_policy(
         policy['wireguard_enabled'], True, policy['primary_protocol'])
+    _invalidate_policy_cache()
     await on_admin_protocols(update, context)
 
 
@@ -377,15 +622,14 @@ async def on_proto_disable_wireguard(update: Update, context: ContextTypes.DEFAU
     """Disable WireGuard protocol"""
     q = update.callback_query
     await q.answer()
-    if not is_admin(q.from_user.id):
-        return
 
-    policy = storage.get_protocol_policy()
+    policy = _get_policy_cached()
 
     try:
         # If WireGuard is primary, switch to VLESS first
         primary = 'vless' if policy['primary_protocol'] == 'wireguard' else policy['primary_protocol']
         storage.set_protocol_policy(False, policy['vless_enabled'], primary)
+        _invalidate_policy_cache()
         await on_admin_protocols(update, context)
     except ValueError as e:
         await q.answer(f"❌ {e}", show_alert=True)
@@ -395,16 +639,15 @@ async def on_proto_disable_vless(update: Update, context: ContextTypes.DEFAULT_T
     """Disable VLESS protocol"""
     q = update.callback_query
     await q.answer()
-    if not is_admin(q.from_user.id):
-        return
 
-    policy = storage.get_protocol_policy()
+    policy = _get_policy_cached()
 
     try:
         # If VLESS is primary, switch to WireGuard first
         primary = 'wireguard' if policy['primary_protocol'] == 'vless' else policy['primary_protocol']
         storage.set_protocol_policy(
             policy['wireguard_enabled'], False, primary)
+        _invalidate_policy_cache()
         await on_admin_protocols(update, context)
     except ValueError as e:
         await q.answer(f"❌ {e}", show_alert=True)
@@ -414,12 +657,11 @@ async def on_proto_primary_wireguard(update: Update, context: ContextTypes.DEFAU
     """Set WireGuard as primary protocol"""
     q = update.callback_query
     await q.answer()
-    if not is_admin(q.from_user.id):
-        return
 
-    policy = storage.get_protocol_policy()
+    policy = _get_policy_cached()
     storage.set_protocol_policy(
         policy['wireguard_enabled'], policy['vless_enabled'], 'wireguard')
+    _invalidate_policy_cache()
     await on_admin_protocols(update, context)
 
 
@@ -427,130 +669,188 @@ async def on_proto_primary_vless(update: Update, context: ContextTypes.DEFAULT_T
     """Set VLESS as primary protocol"""
     q = update.callback_query
     await q.answer()
-    if not is_admin(q.from_user.id):
-        return
 
-    policy = storage.get_protocol_policy()
+    policy = _get_policy_cached()
     storage.set_protocol_policy(
         policy['wireguard_enabled'], policy['vless_enabled'], 'vless')
+    _invalidate_policy_cache()
     await on_admin_protocols(update, context)
 
 
-async def on_get_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-
-    user = query.from_user
+async def _send_vpn_config(message, user):
+    """
+    Shared flow behind /vpn and the get_access button: resolve the
+    user's access for the primary protocol and deliver the config.
+    """
     name = user.full_name or user.username or "client"
 
     # Check protocol policy to determine which config to generate
-    policy = storage.get_protocol_policy()
+    policy = await asyncio.to_thread(_get_policy_cached)
     primary = policy['primary_protocol']
 
     # Check if user already has access
     if primary == 'wireguard':
-        devices = storage.get_peers_by_telegram_id(user.id)
+        devices = await asyncio.to_thread(_peers_for, user.id)
         has_access = len(devices) > 0
     else:  # vless
-        peer = storage.get_vless_peer_by_telegram_id(user.id)
+        peer = await asyncio.to_thread(_vless_peer_for, user.id)
         has_access = peer is not None
 
     if has_access:
-        await query.message.reply_text(
+        await message.reply_text(
             "ℹ️ У вас уже есть активный VPN-доступ.\n\n"
             "Отправляю текущую конфигурацию 👇"
         )
 
     # Generate config based on primary protocol
-    try:
-        if primary == 'wireguard':
-            config = get_or_create_peer_and_config(
-                telegram_id=user.id,
-                name=name,
-                ttl_days=30,
-            )
-
-            # Send as .conf file
-            filename = f"{safe_filename(BOT_NAME)}.conf"
-            await query.message.reply_document(
-                document=config.encode(),
-                filename=filename,
-                caption="✅ Ваш конфигурационный файл WireGuard.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📡 Как установить",
-                                          callback_data="how_install")],
-                    [InlineKeyboardButton("🏠 Главное меню",
-                                          callback_data="back_to_main")],
-                ]),
-            )
-        else:  # vless
-            vless_link = get_or_create_vless_config(
-                telegram_id=user.id,
-                name=name,
-                ttl_days=30,
-            )
-
-            # Send as text with vless:// link
-            caption = (
-                "✅ Ваша конфигурация VLESS Reality\n\n"
-                "Скопируйте ссылку ниже и добавьте в клиент VPN:"
-            )
-            await query.message.reply_text(
-                f"{caption}\n\n<code>{vless_link}</code>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📡 Как установить",
-                                          callback_data="how_install")],
-                    [InlineKeyboardButton("🏠 Главное меню",
-                                          callback_data="back_to_main")],
-                ]),
-            )
-    except (ProvisionError, VLESSProvisionError) as e:
-        await query.message.reply_text(f"❌ Доступ недоступен:\n{e}")
-        return
+    lock = _PROVISION_LOCKS.setdefault(user.id, asyncio.Lock())
+    async with lock:
+        try:
+            if primary == 'wireguard':
+                config_bytes = _get_cached_config(user.id)
+                if config_bytes is None:
+                    if devices:
+                        # Known peer: rebuild the config from the stored row
+                        # instead of re-entering the provisioning path
+                        peer = devices[0]
+                        if not peer["enabled"]:
+                            raise ProvisionError("Access is disabled or expired")
+                        config = await asyncio.to_thread(
+                            wg.generate_client_config,
+                            peer["private_key"],
+                            peer["ip"],
+                        )
+                    else:
+                        # The limit counts the device about to be created,
+                        # so MAX_DEVICES_PER_USER=0 really blocks signups
+                        # and the guard stays correct once multi-device
+                        # support lands
+                        if len(devices) + 1 > MAX_DEVICES_PER_USER:
+                            raise ProvisionError(
+                                "Достигнут лимит устройств для этого аккаунта")
+                        config = await asyncio.to_thread(
+                            get_or_create_peer_and_config,
+                            telegram_id=user.id,
+                            name=name,
+                            ttl_days=30,
+                        )
+                        _PEERS_CACHE.pop(user.id, None)
+                    config_bytes = config.encode()
+                    _cache_config(user.id, config_bytes)
+
+                # Send as .conf file
+                config_hash = hashlib.sha256(config_bytes).hexdigest()
+                cached = _FILE_ID_CACHE.get(user.id)
+                if cached and cached[0] == config_hash:
+                    file_id = cached[1]
+                else:
+                    file_id = await asyncio.to_thread(
+                        storage.get_config_file_id, user.id, config_hash)
+                sent = None
+                if file_id:
+                    try:
+                        sent = await message.reply_document(
+                            document=file_id,
+                            filename=_CONF_FILENAME,
+                            caption="✅ Ваш конфигурационный файл WireGuard.",
+                            reply_markup=_KB_CONFIG_DELIVERED,
+                        )
+                    except BadRequest:
+                        # file_ids are scoped to the bot token, so a token
+                        # rotation invalidates every stored id; fall back
+                        # to the bytes and persist the fresh id below
+                        logger.warning(
+                            "Stale config file_id for user %s; resending bytes",
+                            user.id)
+                        _FILE_ID_CACHE.pop(user.id, None)
+                        file_id = None
+                if sent is None:
+                    sent = await message.reply_document(
+                        document=config_bytes,
+                        filename=_CONF_FILENAME,
+                        caption="✅ Ваш конфигурационный файл WireGuard.",
+                        reply_markup=_KB_CONFIG_DELIVERED,
+                    )
+                if sent.document and sent.document.file_id != file_id:
+                    _FILE_ID_CACHE[user.id] = (config_hash, sent.document.file_id)
+                    await asyncio.to_thread(
+                        storage.save_config_file_id,
+                        user.id, sent.document.file_id, config_hash)
+            else:  # vless
+                vless_link = await asyncio.to_thread(
+                    get_or_create_vless_config,
+                    telegram_id=user.id,
+                    name=name,
+                    ttl_days=30,
+                )
+                _VLESS_PEER_CACHE.pop(user.id, None)
+
+                # Send as text with vless:// link
+                caption = (
+                    "✅ Ваша конфигурация VLESS Reality\n\n"
+                    "Скопируйте ссылку ниже и добавьте в клиент VPN:"
+                )
+                await message.reply_text(
+                    f"{caption}\n\n<code>{vless_link}</code>",
+                    parse_mode="HTML",
+                    reply_markup=_KB_CONFIG_DELIVERED,
+                )
+        except (ProvisionError, VLESSProvisionError) as e:
+            await message.reply_text(f"❌ Доступ недоступен:\n{e}")
 
 
-async def on_check_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def on_get_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    await _send_vpn_config(query.message, query.from_user)
 
-    devices = storage.get_peers_by_telegram_id(query.from_user.id)
-    peer = devices[0] if devices else None
 
-    if not peer:
-        msg = "❌ Доступ не найден."
-        if SUPPORT_TG_USERNAME:
-            msg += f"\nОбратитесь: {SUPPORT_TG_USERNAME}"
-        await query.message.reply_text(msg)
-        return
+@functools.lru_cache(maxsize=4096)
+def _fmt_ts(minute_ts: int) -> str:
+    """Format a minute-truncated timestamp; the displayed precision is
+    minutes anyway, so repeat renders become a cache hit"""
+    return datetime.fromtimestamp(minute_ts * 60).strftime("%d.%m.%Y %H:%M")
 
+
+def _render_status(peer) -> str:
+    """Shared status text for on_check_access and cmd_status"""
     status = "✅ Активен" if peer["enabled"] else "⛔ Отключён"
 
     if peer["expires_at"]:
-        expires = datetime.fromtimestamp(
-            peer["expires_at"]).strftime("%d.%m.%Y %H:%M")
-        expires_text = f"📅 Действует до: {expires}"
+        expires_text = f"📅 Действует до: {_fmt_ts(peer['expires_at'] // 60)}"
     else:
         expires_text = "📅 Срок действия: без ограничения"
 
-    text = (
+    return (
         "ℹ️ Статус доступа\n\n"
         f"{status}\n"
         f"{expires_text}\n"
         f"🌐 IP: {peer['ip']}"
     )
 
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")],
-    ])
-    await query.message.reply_text(text, reply_markup=kb)
+
+async def on_check_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    # cache_time lets Telegram clients swallow repeat presses themselves
+    await query.answer(cache_time=5)
+
+    devices = await asyncio.to_thread(_peers_for, query.from_user.id)
+    peer = devices[0] if devices else None
+
+    if not peer:
+        msg = "❌ Доступ не найден."
+        if SUPPORT_TG_USERNAME:
+            msg += f"\nОбратитесь: {SUPPORT_TG_USERNAME}"
+        await query.message.reply_text(msg)
+        return
+
+    await query.message.reply_text(
+        _render_status(peer), reply_markup=_KB_BACK_MAIN)
 
 
 async def on_how_install(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")],
-    ])
+    await update.callback_query.answer(cache_time=5)
+    kb = _KB_BACK_MAIN
     await update.callback_query.message.reply_text(
         INSTALL_GUIDE_URL or "Недоступно",
         reply_markup=kb
@@ -558,38 +858,21 @@ async def on_how_install(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def on_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")],
-    ])
+    await update.callback_query.answer(cache_time=5)
 
-    if SUPPORT_TG_USERNAME:
-        await update.callback_query.message.reply_text(
-            f"🤝 Поддержка\n\nНапишите нам: {SUPPORT_TG_USERNAME}",
-            reply_markup=kb
-        )
-    else:
-        await update.callback_query.message.reply_text(
-            "🤝 Поддержка\n\nКонтакт не настроен",
-            reply_markup=kb
-        )
+    await update.callback_query.message.reply_text(
+        _SUPPORT_TEXT, reply_markup=_KB_BACK_MAIN)
 
 
 async def on_promo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
-    context.user_data['waiting_for_promo'] = True
+    _PROMO_WAITING.add(update.callback_query.from_user.id)
     await update.callback_query.message.reply_text(
-        "🎟 <b>Введите промокод</b>\n\n"
-        "Промокод имеет формат: XX-XXXX-XXD\n"
-        "Например: AB-JULY-30D\n\n"
-        "Отправьте промокод следующим сообщением.",
-        parse_mode="HTML"
-    )
+        _PROMO_PROMPT_HTML, parse_mode="HTML")
 
 
 async def on_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
+    await update.callback_query.answer(cache_time=5)
 
     text = (
         "💬 <b>Частые вопросы</b>\n\n"
@@ -605,44 +888,41 @@ async def on_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Используйте команду /remove для обращения в поддержку."
     )
 
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")],
-    ])
+    kb = _KB_BACK_MAIN
     await update.callback_query.message.reply_text(text, parse_mode="HTML", reply_markup=kb)
 
 
 async def on_back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Return to main menu"""
     q = update.callback_query
-    await q.answer()
-
-    text = (
-        f"👋 Привет!\n"
-        f"Я <b>{BOT_NAME}</b> — помогу настроить твой VPN.\n\n"
-        "💠 Что я умею:\n"
-        "• сделать защищённый VPN-канал\n"
-        "• выдать конфигурацию WireGuard\n"
-        "• помочь подключиться\n\n"
-        "👇 Нажмите <b>/vpn</b>, чтобы получить доступ."
-    )
+    await q.answer(cache_time=5)
 
     await q.message.reply_text(
-        text=text,
+        text=_GREETING_HTML,
         parse_mode="HTML",
         reply_markup=main_keyboard(q.from_user.id),
     )
 
 
+# Users who pressed the promo button and whose next message is a code.
+# Checked by _InPromoState so ordinary chat text never dispatches into
+# handle_promo_code at all
+_PROMO_WAITING: set[int] = set()
+
+
+class _InPromoState(filters.MessageFilter):
+    def filter(self, message):
+        return message.from_user is not None and message.from_user.id in _PROMO_WAITING
+
+
 async def handle_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Promo code activation handler"""
-    if not context.user_data.get('waiting_for_promo'):
-        return
-
     # Convert to uppercase for consistency (case-insensitive)
     code = update.message.text.strip().upper()
 
-    # Check promo code format
-    if not re.match(r'^[A-Z0-9]{2}-[A-Z]{4}-\d+D$', code):
+    # Check promo code format (cheap length check first to skip the regex
+    # for arbitrary chat text)
+    if not (9 <= len(code) <= 16) or not _PROMO_RE.match(code):
         await update.message.reply_text(
             "❌ Неверный формат промокода.\n\n"
             "Промокод должен иметь формат: XX-XXXX-XXD\n"
@@ -651,26 +931,35 @@ async def handle_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # Check promo code in database
-    promo = storage.get_promo_code(code)
+    code_days = int(code.split('-')[-1].rstrip('D'))
+    user_id = update.effective_user.id
+    now = int(time.time())
 
-    if not promo:
-        await update.message.reply_text(
-            "❌ Промокод не найден.\n\n"
-            "Проверьте правильность ввода и попробуйте снова."
-        )
-        return
+    # Atomic check-and-claim: a single UPDATE that only fires while the
+    # code is unused and its days match, so two racing activations
+    # cannot both succeed
+    days = await asyncio.to_thread(
+        storage.claim_promo_code, code, user_id, now, code_days)
 
-    if promo['activated_at']:
-        await update.message.reply_text(
-            "❌ Этот промокод уже был использован.\n\n"
-            f"Активирован: {datetime.fromtimestamp(promo['activated_at']).strftime('%d.%m.%Y %H:%M')}"
-        )
-        return
+    if days is None:
+        # Claim failed — re-read the row just to produce a precise error
+        promo = await asyncio.to_thread(storage.get_promo_code, code)
 
-    # Additional check: days in code must match database
-    code_days = int(code.split('-')[-1].rstrip('D'))
-    if code_days != promo['days']:
+        if not promo:
+            await update.message.reply_text(
+                "❌ Промокод не найден.\n\n"
+                "Проверьте правильность ввода и попробуйте снова."
+            )
+            return
+
+        if promo['activated_at']:
+            await update.message.reply_text(
+                "❌ Этот промокод уже был использован.\n\n"
+                f"Активирован: {_fmt_ts(promo['activated_at'] // 60)}"
+            )
+            return
+
+        # Days in code don't match database
         await update.message.reply_text(
             "❌ Промокод поврежден или недействителен.\n\n"
             "Обратитесь в поддержку."
@@ -680,41 +969,37 @@ async def handle_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Reset flag only after successful validation
-    context.user_data['waiting_for_promo'] = False
+    _PROMO_WAITING.discard(user_id)
 
-    # Activate promo code
-    days = promo['days']
-    user_id = update.effective_user.id
     user_name = update.effective_user.full_name or update.effective_user.username or "client"
 
     # Get current user
-    peer = storage.get_peer_by_telegram_id(user_id)
+    peer = await asyncio.to_thread(storage.get_peer_by_telegram_id, user_id)
 
     if peer:
         # Update expiration date
-        current_expires = peer['expires_at'] or int(time.time())
+        current_expires = peer['expires_at'] or now
         # If expired, start from current time
-        if current_expires < int(time.time()):
-            current_expires = int(time.time())
-        new_expires = current_expires + (days * 24 * 60 * 60)
-        storage.update_expiry(user_id, new_expires)
+        if current_expires < now:
+            current_expires = now
+        new_expires = current_expires + days * SECONDS_PER_DAY
+        await asyncio.to_thread(storage.update_expiry, user_id, new_expires)
+        _PEERS_CACHE.pop(user_id, None)
+        await asyncio.to_thread(_arm_expiry_from_db, context.job_queue)
 
         # Enable peer in WireGuard if it was disabled
         if not peer['enabled']:
             try:
-                wg.enable_peer(peer['public_key'], peer['ip'])
-                storage.set_enabled(user_id, True)
+                await asyncio.to_thread(
+                    wg.enable_peer, peer['public_key'], peer['ip'])
+                await asyncio.to_thread(storage.set_enabled, user_id, True)
                 logger.info(
                     f"Re-enabled peer for user {user_id} after promo activation")
             except wg.WireGuardError as e:
                 logger.error(f"Failed to enable peer for user {user_id}: {e}")
 
-        expires_date = datetime.fromtimestamp(
-            new_expires).strftime('%d.%m.%Y %H:%M')
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(
-                "🏠 Главное меню", callback_data="back_to_main")],
-        ])
+        expires_date = _fmt_ts(new_expires // 60)
+        kb = _KB_BACK_MAIN
         await update.message.reply_text(
             f"✅ <b>Промокод активирован!</b>\n\n"
             f"Добавлено: {days} дней\n"
@@ -724,16 +1009,16 @@ async def handle_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     else:
         # Create new peer with expiration
-        expires_at = int(time.time()) + (days * 24 * 60 * 60)
+        expires_at = now + days * SECONDS_PER_DAY
         try:
-            config_path = get_or_create_peer_and_config(
+            config_path = await asyncio.to_thread(
+                get_or_create_peer_and_config,
                 user_id, user_name, expires_at)
-            expires_date = datetime.fromtimestamp(
-                expires_at).strftime('%d.%m.%Y %H:%M')
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton(
-                    "🏠 Главное меню", callback_data="back_to_main")],
-            ])
+            # Drop a possibly cached empty device list so /status and
+            # check_access see the new peer immediately
+            _PEERS_CACHE.pop(user_id, None)
+            expires_date = _fmt_ts(expires_at // 60)
+            kb = _KB_BACK_MAIN
             await update.message.reply_text(
                 f"✅ <b>Промокод активирован!</b>\n\n"
                 f"Вам предоставлен доступ на {days} дней до {expires_date}.\n\n"
@@ -743,44 +1028,46 @@ async def handle_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             logger.info(
                 f"Created new peer for user {user_id} with {days} days access")
+            await asyncio.to_thread(_arm_expiry_from_db, context.job_queue)
         except ProvisionError as e:
+            # Provisioning failed — give the code back so it can be retried
+            await asyncio.to_thread(storage.release_promo_code, code)
             await update.message.reply_text(
                 f"❌ Ошибка при создании конфигурации: {e}"
             )
             logger.error(f"Failed to create peer for user {user_id}: {e}")
             return
 
-    # Mark promo code as used
-    storage.activate_promo_code(code, user_id)
     logger.info(f"Promo code {code} activated by user {user_id}")
 
 
 # ===== Commands =====
 
+# Like _GREETING_HTML: depends only on BOT_NAME, formatted once
+_HELP_HTML = (
+    f"📖 <b>Справка {BOT_NAME}</b>\n\n"
+    "<b>Основные команды:</b>\n"
+    "/start - Главное меню\n"
+    "/vpn - Получить VPN конфигурацию\n"
+    "/status - Проверить статус доступа\n"
+    "/help - Показать эту справку\n"
+    "/remove - Удалить VPN доступ\n\n"
+    "<b>Возможности:</b>\n"
+    "• Безопасное VPN подключение\n"
+    "• Промокоды для активации доступа\n"
+    "• Автоматическое управление сроком действия\n"
+    "• Простая установка на всех устройствах"
+)
+
+
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = (
-        f"📖 <b>Справка {BOT_NAME}</b>\n\n"
-        "<b>Основные команды:</b>\n"
-        "/start - Главное меню\n"
-        "/vpn - Получить VPN конфигурацию\n"
-        "/status - Проверить статус доступа\n"
-        "/help - Показать эту справку\n"
-        "/remove - Удалить VPN доступ\n\n"
-        "<b>Возможности:</b>\n"
-        "• Безопасное VPN подключение\n"
-        "• Промокоды для активации доступа\n"
-        "• Автоматическое управление сроком действия\n"
-        "• Простая установка на всех устройствах"
-    )
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")],
-    ])
-    await update.message.reply_text(text, parse_mode="HTML", reply_markup=kb)
+    await update.message.reply_text(
+        _HELP_HTML, parse_mode="HTML", reply_markup=_KB_BACK_MAIN)
 
 
 async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    devices = storage.get_peers_by_telegram_id(user_id)
+    devices = await asyncio.to_thread(_peers_for, user_id)
     peer = devices[0] if devices else None
 
     if not peer:
@@ -789,121 +1076,21 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
             msg += f"Обратитесь: {SUPPORT_TG_USERNAME}"
         else:
             msg += "Используйте промокод для активации доступа."
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(
-                "🏠 Главное меню", callback_data="back_to_main")],
-        ])
+        kb = _KB_BACK_MAIN
         await update.message.reply_text(msg, reply_markup=kb)
         return
 
-    status = "✅ Активен" if peer["enabled"] else "⛔ Отключён"
-
-    if peer["expires_at"]:
-        expires = datetime.fromtimestamp(
-            peer["expires_at"]).strftime("%d.%m.%Y %H:%M")
-        expires_text = f"📅 Действует до: {expires}"
-    else:
-        expires_text = "📅 Срок действия: без ограничения"
-
-    text = (
-        "ℹ️ Статус доступа\n\n"
-        f"{status}\n"
-        f"{expires_text}\n"
-        f"🌐 IP: {peer['ip']}"
-    )
-
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")],
-    ])
-    await update.message.reply_text(text, reply_markup=kb)
+    await update.message.reply_text(
+        _render_status(peer), reply_markup=_KB_BACK_MAIN)
 
 
 async def cmd_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-
-    msg = "⚠️ <b>Удаление VPN доступа</b>\n\n"
-    msg += "Для удаления VPN доступа обратитесь в поддержку.\n"
-
-    if SUPPORT_TG_USERNAME:
-        msg += f"Напишите нам: {SUPPORT_TG_USERNAME}"
-    else:
-        msg += "Контакт поддержки не настроен."
-
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")],
-    ])
-    await update.message.reply_text(msg, parse_mode="HTML", reply_markup=kb)
+    await update.message.reply_text(
+        _REMOVE_HTML, parse_mode="HTML", reply_markup=_KB_BACK_MAIN)
 
 
 async def cmd_vpn(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    name = user.full_name or user.username or "client"
-
-    # Check protocol policy to determine which config to generate
-    policy = storage.get_protocol_policy()
-    primary = policy['primary_protocol']
-
-    # Check if user already has access
-    if primary == 'wireguard':
-        devices = storage.get_peers_by_telegram_id(user.id)
-        has_access = len(devices) > 0
-    else:  # vless
-        peer = storage.get_vless_peer_by_telegram_id(user.id)
-        has_access = peer is not None
-
-    if has_access:
-        await update.message.reply_text(
-            "ℹ️ У вас уже есть активный VPN-доступ.\n"
-            "Отправляю текущую конфигурацию 👇"
-        )
-
-    # Generate config based on primary protocol
-    try:
-        if primary == 'wireguard':
-            config = get_or_create_peer_and_config(
-                telegram_id=user.id,
-                name=name,
-                ttl_days=30,
-            )
-
-            # Send as .conf file
-            filename = f"{safe_filename(BOT_NAME)}.conf"
-            await update.message.reply_document(
-                document=config.encode(),
-                filename=filename,
-                caption="✅ Ваш конфигурационный файл WireGuard.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📡 Как установить",
-                                          callback_data="how_install")],
-                    [InlineKeyboardButton("🏠 Главное меню",
-                                          callback_data="back_to_main")],
-                ]),
-            )
-        else:  # vless
-            vless_link = get_or_create_vless_config(
-                telegram_id=user.id,
-                name=name,
-                ttl_days=30,
-            )
-
-            # Send as text with vless:// link
-            caption = (
-                "✅ Ваша конфигурация VLESS Reality\n\n"
-                "Скопируйте ссылку ниже и добавьте в клиент VPN:"
-            )
-            await update.message.reply_text(
-                f"{caption}\n\n<code>{vless_link}</code>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📡 Как установить",
-                                          callback_data="how_install")],
-                    [InlineKeyboardButton("🏠 Главное меню",
-                                          callback_data="back_to_main")],
-                ]),
-            )
-    except (ProvisionError, VLESSProvisionError) as e:
-        await update.message.reply_text(f"❌ Доступ недоступен:\n{e}")
-        return
+    await _send_vpn_config(update.message, update.effective_user)
 
 
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -911,26 +1098,85 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(user_id):
         await update.message.reply_text("⛔ Доступ запрещён")
         return
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ Создать промокод",
-                              callback_data="admin_promo")],
-        [InlineKeyboardButton("ℹ️ Показать статистику",
-                              callback_data="admin_stats")],
-    ])
-    await update.message.reply_text("🛠 Администрирование", reply_markup=kb)
+    await update.message.reply_text("🛠 Администрирование",
+                                    reply_markup=_KB_ADMIN_CMD)
+
+
+# ===== Callback dispatch =====
+# A single handler with dict lookups replaces 17 pattern handlers that
+# PTB would otherwise regex-match in sequence for every press
+
+_CB_HANDLERS = {
+    "get_access": on_get_access,
+    "check_access": on_check_access,
+    "how_install": on_how_install,
+    "support": on_support,
+    "promo": on_promo,
+    "faq": on_faq,
+    "back_to_main": on_back_to_main,
+}
+
+_CB_ADMIN_HANDLERS = {
+    "admin_panel": on_admin_panel,
+    "admin_promo": on_admin_promo,
+    "admin_stats": on_admin_stats,
+    "admin_protocols": on_admin_protocols,
+    "proto_enable_wireguard": on_proto_enable_wireguard,
+    "proto_enable_vless": on_proto_enable_vless,
+    "proto_disable_wireguard": on_proto_disable_wireguard,
+    "proto_disable_vless": on_proto_disable_vless,
+    "proto_primary_wireguard": on_proto_primary_wireguard,
+    "proto_primary_vless": on_proto_primary_vless,
+}
+
+
+async def _dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    data = update.callback_query.data or ""
+    handler = _CB_HANDLERS.get(data)
+    if handler is None:
+        # Everything else is admin-only; drop non-admin presses
+        # silently, as the per-handler gate did before
+        if not is_admin(update.callback_query.from_user.id):
+            return
+        if data.startswith("promo_days_"):
+            handler = on_promo_days
+        else:
+            handler = _CB_ADMIN_HANDLERS.get(data)
+            if handler is None:
+                return
+    await handler(update, context)
 
 
 def main():
+    # Use the libuv event loop when available (Linux/macOS); falls back
+    # to the stock asyncio loop without it
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("uvloop installed as event loop policy")
+    except ImportError:
+        pass
+
     # Build application with job queue enabled
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Process updates fully in parallel (subprocess and DB work is
+    # already off-loop via to_thread); PTB gives no per-chat ordering
+    # here, so per-user provisioning races are serialized by
+    # _PROVISION_LOCKS in _send_vpn_config
+    app = (ApplicationBuilder()
+           .token(BOT_TOKEN)
+           .concurrent_updates(64)
+           .build())
 
     restore_peers_on_startup()
 
-    # Add periodic job to check and disable expired peers every 30 minutes
-    # Starts after 60 seconds, then runs every 1800 seconds (30 minutes)
     if app.job_queue:
-        app.job_queue.run_repeating(expire_peers_job, interval=1800, first=60)
-        logger.info("Expiry checking job scheduled: runs every 30 minutes")
+        # Hourly watchdog only; the job re-arms itself as a run_once
+        # timed to MIN(expires_at), so expiries land on time instead of
+        # waiting out a fixed polling interval
+        app.job_queue.run_repeating(
+            expire_peers_job, interval=EXPIRE_JOB_INTERVAL, first=60)
+        logger.info(
+            "Expiry watchdog scheduled: hourly sweep plus precise re-arms")
     else:
         logger.warning("JobQueue is not available, expiry checking disabled")
 
@@ -940,42 +1186,31 @@ def main():
     app.add_handler(CommandHandler("status", cmd_status))
     app.add_handler(CommandHandler("remove", cmd_remove))
     app.add_handler(CommandHandler("admin", admin_command))
-    app.add_handler(CallbackQueryHandler(
-        on_admin_panel, pattern="^admin_panel$"))
-    app.add_handler(CallbackQueryHandler(
-        on_admin_promo, pattern="^admin_promo$"))
-    app.add_handler(CallbackQueryHandler(
-        on_promo_days, pattern="^promo_days_"))
-    app.add_handler(CallbackQueryHandler(
-        on_admin_stats, pattern="^admin_stats$"))
-    app.add_handler(CallbackQueryHandler(
-        on_admin_protocols, pattern="^admin_protocols$"))
-    app.add_handler(CallbackQueryHandler(
-        on_proto_enable_wireguard, pattern="^proto_enable_wireguard$"))
-    app.add_handler(CallbackQueryHandler(
-        on_proto_enable_vless, pattern="^proto_enable_vless$"))
-    app.add_handler(CallbackQueryHandler(
-        on_proto_disable_wireguard, pattern="^proto_disable_wireguard$"))
-    app.add_handler(CallbackQueryHandler(
-        on_proto_disable_vless, pattern="^proto_disable_vless$"))
-    app.add_handler(CallbackQueryHandler(
-        on_proto_primary_wireguard, pattern="^proto_primary_wireguard$"))
-    app.add_handler(CallbackQueryHandler(
-        on_proto_primary_vless, pattern="^proto_primary_vless$"))
-    app.add_handler(CallbackQueryHandler(
-        on_back_to_main, pattern="^back_to_main$"))
-    app.add_handler(CallbackQueryHandler(
-        on_get_access, pattern="^get_access$"))
-    app.add_handler(CallbackQueryHandler(
-        on_check_access, pattern="^check_access$"))
-    app.add_handler(CallbackQueryHandler(
-        on_how_install, pattern="^how_install$"))
-    app.add_handler(CallbackQueryHandler(on_support, pattern="^support$"))
-    app.add_handler(CallbackQueryHandler(on_promo, pattern="^promo$"))
-    app.add_handler(CallbackQueryHandler(on_faq, pattern="^faq$"))
+    app.add_handler(CallbackQueryHandler(_dispatch_callback))
     app.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND, handle_promo_code))
-    app.run_polling()
+        filters.TEXT & ~filters.COMMAND & _InPromoState(), handle_promo_code))
+
+    # Only message and callback_query updates are handled, so ask Telegram
+    # to deliver nothing else
+    allowed_updates = ["message", "callback_query"]
+
+    if WEBHOOK_URL:
+        # Webhook mode: Telegram pushes updates to us, no polling round-trips
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}",
+            allowed_updates=allowed_updates,
+        )
+    else:
+        # Long-poll tuning: hold the getUpdates connection open for 30s
+        # and re-poll immediately, instead of sleeping between polls
+        app.run_polling(
+            poll_interval=0.0,
+            timeout=30,
+            allowed_updates=allowed_updates,
+        )
 
 
 if __name__ == '__main__':
@@ -9,37 +9,44 @@ class ProvisionError(Exception):
     pass
 
 
-def get_or_create_peer_and_config(
-    telegram_id: int,
-    name: str,
-    ttl_days: Optional[int] = None
-) -> str:
-    """
-    Main provisioning entrypoint.
+# Конфиг пользователя постоянен (один peer = один конфиг), поэтому
+# собранную строку можно держать в памяти; enabled проверяется по
+# строке peers при каждом обращении
+_CONFIG_CACHE: dict[int, str] = {}
 
-    - One Telegram ID = one peer
-    - One peer = one permanent config
-    - Config content is always identical
-    """
 
-    # 1. Ensure DB is ready
-    storage.init_db()
+def get_existing_peer_config(telegram_id: int) -> Optional[str]:
+    """
+    Fast read-only path: config for an already provisioned peer, or
+    None when the user has no peer yet.
 
-    # 2. Check if peer already exists
+    Raises ProvisionError for a peer that exists but is disabled.
+    """
     peer = storage.get_peer_by_telegram_id(telegram_id)
 
-    if peer:
-        # Peer exists — just ensure it's enabled if not expired
-        if peer["enabled"]:
-            return wg.generate_client_config(
-                peer["private_key"],
-                peer["ip"]
-            )
+    if peer is None:
+        return None
 
+    if not peer["enabled"]:
         # Peer exists but disabled (expired or manually revoked)
         raise ProvisionError("Access is disabled or expired")
 
-    # 3. New peer provisioning
+    config = _CONFIG_CACHE.get(telegram_id)
+    if config is None:
+        config = wg.generate_client_config(
+            peer["private_key"],
+            peer["ip"]
+        )
+        _CONFIG_CACHE[telegram_id] = config
+    return config
+
+
+def create_peer_and_config(
+    telegram_id: int,
+    name: str,
+    ttl_days: Optional[int] = None
+) -> str:
+    """Slow path: keygen, IP allocation, DB insert and wg enable."""
     private_key, public_key = wg.generate_keypair()
     ip = storage.get_next_ip()
 
@@ -47,7 +54,6 @@ def get_or_create_peer_and_config(
     if ttl_days is not None:
         expires_at = int(time.time()) + ttl_days * 86400
 
-    # 4. Persist peer
     storage.create_peer(
         telegram_id=telegram_id,
         name=name,
@@ -57,12 +63,33 @@ def get_or_create_peer_and_config(
         expires_at=expires_at
     )
 
-    # 5. Enable peer in WireGuard
     wg.enable_peer(public_key, ip)
 
-    # 6. Generate and return config
-    return wg.generate_client_config(
+    config = wg.generate_client_config(
         private_key,
         ip
     )
+    _CONFIG_CACHE[telegram_id] = config
+    return config
+
+
+def get_or_create_peer_and_config(
+    telegram_id: int,
+    name: str,
+    ttl_days: Optional[int] = None
+) -> str:
+    """
+    Main provisioning entrypoint.
+
+    - One Telegram ID = one peer
+    - One peer = one permanent config
+    - Config content is always identical
+    """
+
+    # DB schema is created once at bot startup (restore_peers_on_startup)
+    config = get_existing_peer_config(telegram_id)
+    if config is not None:
+        return config
+
+    return create_peer_and_config(telegram_id, name, ttl_days)
 
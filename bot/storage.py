@@ -1,4 +1,6 @@
+import json
 import sqlite3
+import threading
 import time
 from pathlib import Path
 from typing import Optional
@@ -8,6 +10,8 @@ DB_PATH = Path("bot/data.db")
 # First IP issued by bot (reserve lower range for manual peers)
 FIRST_CLIENT_IP = 10
 
+_LOCAL = threading.local()
+
 
 def get_db():
     conn = sqlite3.connect(DB_PATH)
@@ -15,8 +19,42 @@ def get_db():
     return conn
 
 
+def _get_thread_db() -> sqlite3.Connection:
+    """
+    Долгоживущее соединение на поток для горячих запросов: не платим
+    за открытие файла на каждый вызов, а кэш подготовленных statement'ов
+    соединения переиспользует планы запросов.
+    """
+    conn = getattr(_LOCAL, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA busy_timeout=5000")
+        _LOCAL.conn = conn
+    return conn
+
+
+_initialized = False
+
+
 def init_db():
+    # Schema setup is idempotent but not free; after the first call the
+    # hot provisioning path only pays this bool check
+    global _initialized
+    if _initialized:
+        return
     conn = get_db()
+    # WAL keeps readers from blocking behind the writer and is persisted
+    # in the DB file; synchronous=NORMAL drops the extra fsync per commit
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # ~20MB page cache keeps the small peers/promo tables resident
+    conn.execute("PRAGMA cache_size=-20000")
     conn.execute("""
         CREATE TABLE IF NOT EXISTS peers (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -53,6 +91,27 @@ def init_db():
             enabled INTEGER NOT NULL DEFAULT 1
         )
     """)
+    # Telegram file_ids of uploaded .conf documents, so an unchanged
+    # config can be re-sent without uploading the bytes again
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS config_files (
+            telegram_id INTEGER PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            config_hash TEXT NOT NULL
+        )
+    """)
+    # Expiry sweeps and restore hit these predicates every run; partial
+    # index keeps them as range scans instead of table scans
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_peers_enabled_expires
+        ON peers(enabled, expires_at)
+        WHERE expires_at IS NOT NULL
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_vless_enabled_expires
+        ON vless_peers(enabled, expires_at)
+        WHERE expires_at IS NOT NULL
+    """)
     # Settings table for VPN mode (wireguard/vless/hybrid)
     conn.execute("""
         CREATE TABLE IF NOT EXISTS settings (
@@ -62,17 +121,26 @@ def init_db():
     """)
     conn.commit()
     conn.close()
+    _initialized = True
 
 
-def get_peer_by_telegram_id(telegram_id: int) -> Optional[sqlite3.Row]:
-    conn = get_db()
-    cur = conn.execute(
+# Кэш строк peers: горячие обработчики читают одного и того же
+# пользователя многократно, а мутации ниже точечно сбрасывают запись
+_PEER_CACHE_TTL = 600
+_peer_cache: dict[int, tuple[float, Optional[dict]]] = {}
+
+
+def get_peer_by_telegram_id(telegram_id: int) -> Optional[dict]:
+    ent = _peer_cache.get(telegram_id)
+    if ent and ent[0] > time.time():
+        return ent[1]
+    row = _get_thread_db().execute(
         "SELECT * FROM peers WHERE telegram_id = ?",
         (telegram_id,)
-    )
-    row = cur.fetchone()
-    conn.close()
-    return row
+    ).fetchone()
+    value = dict(row) if row else None
+    _peer_cache[telegram_id] = (time.time() + _PEER_CACHE_TTL, value)
+    return value
 
 
 def get_peers_by_telegram_id(telegram_id: int) -> list[sqlite3.Row]:
@@ -80,14 +148,11 @@ def get_peers_by_telegram_id(telegram_id: int) -> list[sqlite3.Row]:
     Возвращает список peer'ов пользователя.
     Сейчас максимум 1, но архитектура готова к нескольким.
     """
-    conn = get_db()
-    cur = conn.execute(
+    cur = _get_thread_db().execute(
         "SELECT * FROM peers WHERE telegram_id = ? ORDER BY id",
         (telegram_id,)
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    return cur.fetchall()
 
 
 def create_peer(
@@ -98,8 +163,9 @@ def create_peer(
     ip: str,
     expires_at: Optional[int]
 ):
-    conn = get_db()
-    conn.execute(
+    now = int(time.time())
+    conn = _get_thread_db()
+    cur = conn.execute(
         """
         INSERT INTO peers (
             telegram_id,
@@ -112,6 +178,7 @@ def create_peer(
             enabled
         )
         VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+        RETURNING *
         """,
         (
             telegram_id,
@@ -119,48 +186,71 @@ def create_peer(
             private_key,
             public_key,
             ip,
-            int(time.time()),
+            now,
             expires_at
         )
     )
+    row = cur.fetchone()
     conn.commit()
-    conn.close()
+    # Прогреваем кэш свежей строкой: первый же запрос конфига после
+    # создания peer'а обходится без SELECT
+    value = dict(row)
+    _peer_cache[telegram_id] = (time.time() + _PEER_CACHE_TTL, value)
+    return value
 
 
 def update_expiry(telegram_id: int, expires_at: int):
-    conn = get_db()
+    conn = _get_thread_db()
     conn.execute(
         "UPDATE peers SET expires_at = ? WHERE telegram_id = ?",
         (expires_at, telegram_id)
     )
     conn.commit()
-    conn.close()
+    _peer_cache.pop(telegram_id, None)
 
 
 def set_enabled(telegram_id: int, enabled: bool):
-    conn = get_db()
+    conn = _get_thread_db()
     conn.execute(
         "UPDATE peers SET enabled = ? WHERE telegram_id = ?",
         (1 if enabled else 0, telegram_id)
     )
     conn.commit()
-    conn.close()
+    _peer_cache.pop(telegram_id, None)
+
+
+def set_enabled_bulk(telegram_ids: list[int], enabled: bool):
+    """
+    Включает/выключает сразу несколько peer'ов одним UPDATE
+    (одна транзакция вместо N коммитов).
+    """
+    if not telegram_ids:
+        return
+    placeholders = ",".join("?" * len(telegram_ids))
+    conn = _get_thread_db()
+    conn.execute(
+        f"UPDATE peers SET enabled = ? WHERE telegram_id IN ({placeholders})",
+        (1 if enabled else 0, *telegram_ids)
+    )
+    conn.commit()
+    for telegram_id in telegram_ids:
+        _peer_cache.pop(telegram_id, None)
 
 
 def delete_peer(telegram_id: int):
-    conn = get_db()
+    conn = _get_thread_db()
     conn.execute(
         "DELETE FROM peers WHERE telegram_id = ?",
         (telegram_id,)
     )
     conn.commit()
-    conn.close()
+    _peer_cache.pop(telegram_id, None)
 
 
 def get_peers_for_restore(now_ts: int):
-    conn = get_db()
+    conn = _get_thread_db()
     cur = conn.execute(
-        """SELECT * FROM peers
+        """SELECT public_key, ip, telegram_id FROM peers
         WHERE enabled = 1
           AND (expires_at IS NULL OR expires_at > ?)
         ORDER BY id
@@ -168,14 +258,13 @@ def get_peers_for_restore(now_ts: int):
         (now_ts,),
     )
     rows = cur.fetchall()
-    conn.close()
     return rows
 
 
 def get_expired_peers(now_ts: int):
-    conn = get_db()
+    conn = _get_thread_db()
     cur = conn.execute(
-        """SELECT * FROM peers
+        """SELECT public_key, ip, telegram_id FROM peers
         WHERE enabled = 1
           AND expires_at IS NOT NULL
           AND expires_at <= ?
@@ -184,29 +273,50 @@ def get_expired_peers(now_ts: int):
         (now_ts,),
     )
     rows = cur.fetchall()
-    conn.close()
     return rows
 
 
-def get_next_ip(subnet_prefix: str = "10.8.0.") -> str:
-    conn = get_db()
-    cur = conn.execute(
-        "SELECT ip FROM peers ORDER BY id DESC LIMIT 1"
+def get_next_expiry() -> Optional[int]:
+    """
+    Ближайший expires_at среди включённых peer'ов (WG и VLESS) —
+    позволяет джобе истечения не сканировать таблицы впустую.
+    """
+    cur = _get_thread_db().execute(
+        """
+        SELECT MIN(ts) AS ts FROM (
+            SELECT MIN(expires_at) AS ts FROM peers
+            WHERE enabled = 1 AND expires_at IS NOT NULL
+            UNION ALL
+            SELECT MIN(expires_at) AS ts FROM vless_peers
+            WHERE enabled = 1 AND expires_at IS NOT NULL
+        )
+        """
     )
     row = cur.fetchone()
-    conn.close()
+    return row["ts"] if row and row["ts"] is not None else None
 
-    if row is None:
-        return f"{subnet_prefix}{FIRST_CLIENT_IP}"
 
-    last_ip = row["ip"]
-    last_octet = int(last_ip.split(".")[-1])
-    return f"{subnet_prefix}{last_octet + 1}"
+# Счётчик последнего октета: один раз считывается из БД, дальше
+# выдача IP — инкремент в памяти под локом (без запроса на каждый peer)
+_ip_lock = threading.Lock()
+_last_octet: Optional[int] = None
+
+
+def get_next_ip(subnet_prefix: str = "10.8.0.") -> str:
+    global _last_octet
+    with _ip_lock:
+        if _last_octet is None:
+            cur = _get_thread_db().execute("SELECT ip FROM peers")
+            octets = [int(row["ip"].rsplit(".", 1)[1])
+                      for row in cur.fetchall()]
+            _last_octet = max(octets, default=FIRST_CLIENT_IP - 1)
+        _last_octet += 1
+        return f"{subnet_prefix}{_last_octet}"
 
 
 def save_promo_code(code: str, days: int, created_by: int):
     """Сохраняет созданный промокод"""
-    conn = get_db()
+    conn = _get_thread_db()
     conn.execute(
         """
         INSERT INTO promo_codes (code, days, created_at, created_by)
@@ -215,39 +325,89 @@ def save_promo_code(code: str, days: int, created_by: int):
         (code, days, int(time.time()), created_by)
     )
     conn.commit()
-    conn.close()
 
 
 def get_promo_code(code: str) -> Optional[sqlite3.Row]:
     """Возвращает информацию о промокоде"""
-    conn = get_db()
-    cur = conn.execute(
+    cur = _get_thread_db().execute(
         "SELECT * FROM promo_codes WHERE code = ?",
         (code,)
     )
+    return cur.fetchone()
+
+
+def claim_promo_code(
+    code: str,
+    activated_by: int,
+    now_ts: int,
+    days: int
+) -> Optional[int]:
+    """
+    Атомарно активирует промокод одним UPDATE.
+
+    Срабатывает только если код существует, ещё не использован и его
+    срок совпадает с ожидаемым — гонка двух активаций невозможна.
+    Возвращает days при успехе, иначе None.
+    """
+    conn = _get_thread_db()
+    cur = conn.execute(
+        """
+        UPDATE promo_codes
+        SET activated_at = ?, activated_by = ?
+        WHERE code = ? AND activated_at IS NULL AND days = ?
+        RETURNING days
+        """,
+        (now_ts, activated_by, code, days)
+    )
     row = cur.fetchone()
-    conn.close()
-    return row
+    conn.commit()
+    return row["days"] if row else None
 
 
-def activate_promo_code(code: str, activated_by: int):
-    """Помечает промокод как активированный"""
-    conn = get_db()
+def release_promo_code(code: str):
+    """Откатывает активацию (если выдача доступа не удалась)"""
+    conn = _get_thread_db()
     conn.execute(
         """
-        UPDATE promo_codes 
-        SET activated_at = ?, activated_by = ? 
+        UPDATE promo_codes
+        SET activated_at = NULL, activated_by = NULL
         WHERE code = ?
         """,
-        (int(time.time()), activated_by, code)
+        (code,)
+    )
+    conn.commit()
+
+
+def get_config_file_id(telegram_id: int, config_hash: str) -> Optional[str]:
+    """Возвращает file_id, если загруженный конфиг всё ещё актуален"""
+    conn = _get_thread_db()
+    cur = conn.execute(
+        """
+        SELECT file_id FROM config_files
+        WHERE telegram_id = ? AND config_hash = ?
+        """,
+        (telegram_id, config_hash)
+    )
+    row = cur.fetchone()
+    return row["file_id"] if row else None
+
+
+def save_config_file_id(telegram_id: int, file_id: str, config_hash: str):
+    """Сохраняет file_id загруженного конфига"""
+    conn = _get_thread_db()
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO config_files (telegram_id, file_id, config_hash)
+        VALUES (?, ?, ?)
+        """,
+        (telegram_id, file_id, config_hash)
     )
     conn.commit()
-    conn.close()
 
 
 def get_promo_stats():
     """Возвращает статистику по промокодам"""
-    conn = get_db()
+    conn = _get_thread_db()
     cur = conn.execute("""
         SELECT 
             COUNT(*) as total,
@@ -265,7 +425,6 @@ def get_promo_stats():
     """)
     recent = cur.fetchall()
 
-    conn.close()
     return stats, recent
 
 
@@ -273,7 +432,7 @@ def get_promo_stats():
 
 def create_vless_peer(telegram_id: int, name: str, uuid: str, expires_at: int = None):
     """Create new VLESS peer"""
-    conn = get_db()
+    conn = _get_thread_db()
     conn.execute(
         """
         INSERT INTO vless_peers (telegram_id, name, uuid, created_at, expires_at, enabled)
@@ -282,81 +441,88 @@ def create_vless_peer(telegram_id: int, name: str, uuid: str, expires_at: int =
         (telegram_id, name, uuid, int(time.time()), expires_at)
     )
     conn.commit()
-    conn.close()
 
 
 def get_vless_peer_by_telegram_id(telegram_id: int) -> Optional[sqlite3.Row]:
     """Get VLESS peer by telegram ID"""
-    conn = get_db()
-    cur = conn.execute(
+    cur = _get_thread_db().execute(
         "SELECT * FROM vless_peers WHERE telegram_id = ?",
         (telegram_id,)
     )
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return cur.fetchone()
 
 
 def delete_vless_peer(telegram_id: int):
     """Delete VLESS peer by telegram ID"""
-    conn = get_db()
+    conn = _get_thread_db()
     conn.execute(
         "DELETE FROM vless_peers WHERE telegram_id = ?",
         (telegram_id,)
     )
     conn.commit()
-    conn.close()
 
 
 def update_vless_expiry(telegram_id: int, expires_at: int):
     """Update VLESS peer expiration date"""
-    conn = get_db()
+    conn = _get_thread_db()
     conn.execute(
         "UPDATE vless_peers SET expires_at = ? WHERE telegram_id = ?",
         (expires_at, telegram_id)
     )
     conn.commit()
-    conn.close()
 
 
 def set_vless_enabled(telegram_id: int, enabled: bool):
     """Enable or disable VLESS peer"""
-    conn = get_db()
+    conn = _get_thread_db()
     conn.execute(
         "UPDATE vless_peers SET enabled = ? WHERE telegram_id = ?",
         (1 if enabled else 0, telegram_id)
     )
     conn.commit()
-    conn.close()
+
+
+def set_vless_enabled_bulk(telegram_ids: list[int], enabled: bool):
+    """
+    Включает/выключает сразу несколько VLESS peer'ов одним UPDATE
+    (одна транзакция вместо N коммитов).
+    """
+    if not telegram_ids:
+        return
+    placeholders = ",".join("?" * len(telegram_ids))
+    conn = _get_thread_db()
+    conn.execute(
+        f"UPDATE vless_peers SET enabled = ? WHERE telegram_id IN ({placeholders})",
+        (1 if enabled else 0, *telegram_ids)
+    )
+    conn.commit()
 
 
 def get_vless_peers_for_restore(now_ts: int) -> list[sqlite3.Row]:
     """Get all VLESS peers that should be enabled (not expired)"""
-    conn = get_db()
+    conn = _get_thread_db()
     cur = conn.execute(
         """
-        SELECT * FROM vless_peers 
+        SELECT uuid, name, telegram_id FROM vless_peers
         WHERE enabled = 1 AND (expires_at IS NULL OR expires_at > ?)
         """,
         (now_ts,)
     )
     rows = cur.fetchall()
-    conn.close()
     return rows
 
 
 def get_expired_vless_peers(now_ts: int) -> list[sqlite3.Row]:
     """Get all expired VLESS peers that are still enabled"""
-    conn = get_db()
+    conn = _get_thread_db()
     cur = conn.execute(
         """
-        SELECT * FROM vless_peers 
+        SELECT uuid, name, telegram_id FROM vless_peers
         WHERE enabled = 1 AND expires_at IS NOT NULL AND expires_at <= ?
         """,
         (now_ts,)
     )
     rows = cur.fetchall()
-    conn.close()
     return rows
 
 
@@ -374,15 +540,13 @@ def get_protocol_policy() -> dict:
 
     Default: WireGuard enabled and primary, VLESS disabled
     """
-    conn = get_db()
+    conn = _get_thread_db()
     cur = conn.execute(
         "SELECT value FROM settings WHERE key = 'protocol_policy'",
     )
     row = cur.fetchone()
-    conn.close()
 
     if row:
-        import json
         return json.loads(row['value'])
 
     # Default policy
@@ -419,17 +583,15 @@ def set_protocol_policy(wireguard_enabled: bool, vless_enabled: bool, primary_pr
         raise ValueError("Primary protocol must be enabled")
 
     # Save policy as JSON
-    import json
     policy = {
         'wireguard_enabled': wireguard_enabled,
         'vless_enabled': vless_enabled,
         'primary_protocol': primary_protocol
     }
 
-    conn = get_db()
+    conn = _get_thread_db()
     conn.execute(
         "INSERT OR REPLACE INTO settings (key, value) VALUES ('protocol_policy', ?)",
         (json.dumps(policy),)
     )
     conn.commit()
-    conn.close()
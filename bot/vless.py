@@ -4,10 +4,20 @@ Handles adding/removing clients and reloading Xray service
 """
 import os
 import json
+import logging
+import shutil
 import subprocess
+import threading
 from pathlib import Path
 from urllib.parse import quote
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - stdlib json fallback
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
 
 class VLESSError(Exception):
     """VLESS operation error"""
@@ -33,34 +43,63 @@ if not XRAY_SERVER_ADDRESS:
 if not XRAY_PUBLIC_KEY:
     raise VLESSError("XRAY_PUBLIC_KEY environment variable is required")
 
+# Reality parameters are fixed per deployment, so the query string is
+# built once at import instead of per generated link
+_PARAM_STR = (
+    f"type=tcp&security=reality&pbk={XRAY_PUBLIC_KEY}"
+    f"&fp=chrome&sni={XRAY_SERVER_NAME}&flow=xtls-rprx-vision"
+)
+if XRAY_SHORT_ID:
+    _PARAM_STR += f"&sid={XRAY_SHORT_ID}"
+
+
+# Parsed config keyed by file mtime: back-to-back client changes skip
+# the disk read and JSON parse unless someone edited the file externally
+_config_cache = None  # (st_mtime_ns, parsed config)
+
 
 def _load_config() -> dict:
     """Load Xray configuration from file"""
+    global _config_cache
     try:
-        with open(XRAY_CONFIG_PATH, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        mtime = os.stat(XRAY_CONFIG_PATH).st_mtime_ns
+        if _config_cache is not None and _config_cache[0] == mtime:
+            return _config_cache[1]
+        with open(XRAY_CONFIG_PATH, 'rb') as f:
+            raw = f.read()
+        # orjson parses large client lists several times faster than
+        # stdlib json; both raise ValueError subclasses on bad input
+        config = orjson.loads(raw) if orjson is not None else json.loads(raw)
+        _config_cache = (mtime, config)
+        return config
     except FileNotFoundError:
         raise VLESSError(f"Xray config not found: {XRAY_CONFIG_PATH}")
-    except json.JSONDecodeError as e:
+    except ValueError as e:
         raise VLESSError(f"Invalid Xray config JSON: {e}")
 
 
 def _save_config(config: dict) -> None:
     """Save Xray configuration to file"""
+    global _config_cache
     try:
         # Create backup
         backup_path = f"{XRAY_CONFIG_PATH}.backup"
         if Path(XRAY_CONFIG_PATH).exists():
-            subprocess.run(
-                ["cp", XRAY_CONFIG_PATH, backup_path],
-                check=True,
-                capture_output=True
-            )
-
-        # Save new configuration
-        with open(XRAY_CONFIG_PATH, 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
+            shutil.copyfile(XRAY_CONFIG_PATH, backup_path)
+
+        # Write to a temp file and swap atomically so Xray never sees
+        # a half-written config
+        tmp_path = f"{XRAY_CONFIG_PATH}.tmp"
+        if orjson is not None:
+            with open(tmp_path, 'wb') as f:
+                f.write(orjson.dumps(config, option=orjson.OPT_INDENT_2))
+        else:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(config, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, XRAY_CONFIG_PATH)
+        _config_cache = (os.stat(XRAY_CONFIG_PATH).st_mtime_ns, config)
     except Exception as e:
+        _config_cache = None
         raise VLESSError(f"Failed to save Xray config: {e}")
 
 
@@ -79,6 +118,35 @@ def _find_vless_inbound(config: dict) -> dict:
     return None
 
 
+# Restarting Xray drops every live VLESS connection, so back-to-back
+# enable/disable calls (expiry sweep, startup restore) coalesce into a
+# single restart instead of one per client
+_RELOAD_DEBOUNCE = 2.0
+_reload_lock = threading.Lock()
+_reload_timer = None
+
+
+def _schedule_reload() -> None:
+    """Schedule a debounced Xray restart, coalescing rapid config changes"""
+    global _reload_timer
+    with _reload_lock:
+        if _reload_timer is not None:
+            _reload_timer.cancel()
+        _reload_timer = threading.Timer(_RELOAD_DEBOUNCE, _debounced_reload)
+        _reload_timer.daemon = True
+        _reload_timer.start()
+
+
+def _debounced_reload() -> None:
+    global _reload_timer
+    with _reload_lock:
+        _reload_timer = None
+    try:
+        _reload_xray()
+    except VLESSError as e:
+        logger.error("Deferred Xray restart failed: %s", e)
+
+
 def _reload_xray() -> None:
     """Restart Xray service after config change"""
     try:
@@ -159,8 +227,8 @@ def enable_client(uuid: str, email: str = None) -> None:
     # Save configuration
     _save_config(config)
 
-    # Restart Xray
-    _reload_xray()
+    # Restart Xray (debounced)
+    _schedule_reload()
 
 
 def disable_client(uuid: str) -> None:
@@ -186,8 +254,8 @@ def disable_client(uuid: str) -> None:
     # Save configuration
     _save_config(config)
 
-    # Restart Xray
-    _reload_xray()
+    # Restart Xray (debounced)
+    _schedule_reload()
 
 
 def generate_vless_link(uuid: str, user_name: str = None) -> str:
@@ -202,23 +270,6 @@ def generate_vless_link(uuid: str, user_name: str = None) -> str:
     Returns:
         VLESS URL in format vless://UUID@SERVER:PORT?params#name
     """
-    # Build Reality parameters - minimal required set
-    params = {
-        "type": "tcp",
-        "security": "reality",
-        "pbk": XRAY_PUBLIC_KEY,
-        "fp": "chrome",
-        "sni": XRAY_SERVER_NAME,
-        "flow": "xtls-rprx-vision"
-    }
-
-    # Add short ID if configured
-    if XRAY_SHORT_ID:
-        params["sid"] = XRAY_SHORT_ID
-
-    # Build parameter string
-    param_str = "&".join(f"{k}={v}" for k, v in params.items())
-
     # Build display name with prefix
     if user_name:
         display_name = f"{XRAY_CONFIG_PREFIX} - {user_name}"
@@ -230,6 +281,6 @@ def generate_vless_link(uuid: str, user_name: str = None) -> str:
 
     # Build VLESS URL
     # Format: vless://UUID@SERVER:PORT?params#name
-    vless_url = f"vless://{uuid}@{XRAY_SERVER_ADDRESS}?{param_str}#{encoded_name}"
+    vless_url = f"vless://{uuid}@{XRAY_SERVER_ADDRESS}?{_PARAM_STR}#{encoded_name}"
 
     return vless_url
@@ -35,10 +35,9 @@ def get_or_create_vless_config(
         VLESS URL (vless:// link)
     """
 
-    # 1. Ensure DB is ready
-    storage.init_db()
+    # DB schema is created once at bot startup (restore_peers_on_startup)
 
-    # 2. Check if VLESS peer already exists
+    # 1. Check if VLESS peer already exists
     peer = storage.get_vless_peer_by_telegram_id(telegram_id)
 
     if peer:
@@ -51,14 +50,14 @@ def get_or_create_vless_config(
         # Peer exists but disabled (expired or manually revoked)
         raise VLESSProvisionError("Access is disabled or expired")
 
-    # 3. New peer provisioning - generate UUID
+    # 2. New peer provisioning - generate UUID
     client_uuid = str(uuid.uuid4())
 
     expires_at = None
     if ttl_days is not None:
         expires_at = int(time.time()) + ttl_days * 86400
 
-    # 4. Persist peer in database
+    # 3. Persist peer in database
     storage.create_vless_peer(
         telegram_id=telegram_id,
         name=name,
@@ -66,7 +65,7 @@ def get_or_create_vless_config(
         expires_at=expires_at
     )
 
-    # 5. Enable peer in Xray system
+    # 4. Enable peer in Xray system
     try:
         # Use telegram_id as email for identification in Xray logs
         email = f"tg_{telegram_id}"
@@ -76,7 +75,7 @@ def get_or_create_vless_config(
         storage.delete_vless_peer(telegram_id)
         raise VLESSProvisionError(f"Failed to enable VLESS client: {e}")
 
-    # 6. Generate and return VLESS link
+    # 5. Generate and return VLESS link
     vless_link = vless.generate_vless_link(client_uuid, name)
 
     return vless_link
@@ -1,7 +1,21 @@
+import base64
+import functools
 import os
+import secrets
 import subprocess
 from typing import Tuple
 
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import (
+        X25519PrivateKey,
+    )
+    from cryptography.hazmat.primitives.serialization import (
+        Encoding,
+        PublicFormat,
+    )
+except ImportError:  # pragma: no cover - fallback to the wg binary
+    X25519PrivateKey = None
+
 # ===== Environment configuration =====
 
 WG_INTERFACE = os.getenv("WG_INTERFACE", "wg0")
@@ -41,13 +55,31 @@ def _run(cmd, input_text=None) -> str:
 def generate_keypair() -> Tuple[str, str]:
     """
     Generate WireGuard private/public keypair.
+
+    Uses in-process X25519 when cryptography is available (no forks),
+    otherwise falls back to the wg binary.
     """
+    if X25519PrivateKey is not None:
+        # WireGuard private keys are clamped Curve25519 scalars (RFC 7748)
+        raw = bytearray(secrets.token_bytes(32))
+        raw[0] &= 248
+        raw[31] &= 127
+        raw[31] |= 64
+        priv = X25519PrivateKey.from_private_bytes(bytes(raw))
+        pub = priv.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        return (
+            base64.b64encode(bytes(raw)).decode(),
+            base64.b64encode(pub).decode(),
+        )
     private_key = _run(["wg", "genkey"])
     public_key = _run(["wg", "pubkey"], input_text=private_key)
     return private_key, public_key
 
 
+@functools.lru_cache(maxsize=1)
 def get_server_public_key() -> str:
+    # The server key never changes at runtime; read it once instead of
+    # hitting the disk for every generated client config
     with open(WG_SERVER_PUBLIC_KEY_PATH, "r") as f:
         return f.read().strip()
 
@@ -60,6 +92,45 @@ def enable_peer(public_key: str, ip: str):
     ])
 
 
+# Peers per `wg set` invocation; keeps argv comfortably under ARG_MAX
+_BULK_CHUNK = 500
+
+
+def enable_peers_bulk(peers) -> None:
+    """
+    Enable many peers with a few `wg set` invocations.
+
+    `wg set` accepts repeated peer sections, so restoring N peers costs
+    one fork/exec per chunk instead of N.
+    """
+    for start in range(0, len(peers), _BULK_CHUNK):
+        cmd = ["wg", "set", WG_INTERFACE]
+        for public_key, ip in peers[start:start + _BULK_CHUNK]:
+            cmd += ["peer", public_key, "allowed-ips", f"{ip}/32"]
+        _run(cmd)
+
+
+def dump_peers() -> set:
+    """
+    Public keys currently configured on the interface, from a single
+    `wg show <iface> dump` call.
+    """
+    out = _run(["wg", "show", WG_INTERFACE, "dump"])
+    lines = out.splitlines()
+    # First line describes the interface itself; peers follow as TSV
+    # with the public key in the first column
+    return {line.split("\t", 1)[0] for line in lines[1:] if line}
+
+
+def disable_peers_bulk(public_keys) -> None:
+    """Remove many peers with a few `wg set` invocations."""
+    for start in range(0, len(public_keys), _BULK_CHUNK):
+        cmd = ["wg", "set", WG_INTERFACE]
+        for public_key in public_keys[start:start + _BULK_CHUNK]:
+            cmd += ["peer", public_key, "remove"]
+        _run(cmd)
+
+
 def disable_peer(public_key: str):
     _run([
         "wg", "set", WG_INTERFACE,